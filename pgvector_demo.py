@@ -4,21 +4,803 @@ OpenTenbase 产品推荐系统 Demo
 """
 
 import os
+import numbers
+import threading
+import time
+from collections import OrderedDict
 import psycopg2
+from psycopg2.extras import execute_values
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from typing import List, Tuple, Dict
+from typing import Any, Callable, Iterable, List, MutableMapping, Optional, Sequence, Set, Tuple, Dict, Union
 import json
+from decimal import Decimal
+
+
+class BehaviorIngestor:
+    """
+    用户行为批量写入器
+
+    事件先写入内存缓冲区，同一刷新窗口内相同的 (user_id, product_id, action_type)
+    会被预聚合为一行（累加 event_count，评分取最后一次非空值），
+    达到数量阈值或时间阈值时由后台线程通过 execute_values 批量写入。
+    写入器使用独立的数据库连接，不会阻塞搜索和推荐查询。
+    连接失败时事件会合并回缓冲区重试并自动重连；数据错误的行被隔离丢弃，计入 rejected_events；
+    积压事件数超过 max_backlog 或写入器关闭后，新事件被丢弃并计入 dropped_events。
+    """
+
+    INSERT_SQL = """
+    INSERT INTO user_behaviors (user_id, product_id, action_type, rating, event_count)
+    VALUES %s
+    """
+
+    def __init__(self, db_config: Dict[str, str], batch_size: int = 1000,
+                 flush_interval: float = 1.0,
+                 on_flush: Optional[Callable[[Set[int]], None]] = None,
+                 max_backlog: int = 100000):
+        """
+        Args:
+            db_config: 数据库连接配置
+            batch_size: 缓冲事件数达到该值时触发刷新
+            flush_interval: 最长刷新间隔（秒）
+            on_flush: 刷新成功后的回调，参数为本次写入涉及的用户ID集合
+            max_backlog: 缓冲区最多积压的事件数
+        """
+        self.db_config = db_config
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.max_backlog = max_backlog
+        self.conn = None
+
+        self._buffer: Dict[Tuple[int, int, str], List] = {}
+        self._pending_events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._flush_count = 0
+        self._failed_flushes = 0
+        self._dropped_events = 0
+        self._rejected_events = 0
+        self._rejected_rows = 0
+        self._flushed_events = 0
+        self._flushed_rows = 0
+        self._last_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+
+    def start(self):
+        """建立独立连接并启动后台刷新线程"""
+        self.conn = psycopg2.connect(**self.db_config)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="behavior-ingestor", daemon=True)
+        self._thread.start()
+        return self
+
+    def add(self, user_id: int, product_id: int, action_type: str, rating: Optional[int] = None) -> bool:
+        """
+        缓冲一条用户行为事件
+
+        Returns:
+            事件未被接收时返回 False：评分不在 1~5 范围内（计入 rejected_events），
+            或积压已满、写入器已关闭（计入 dropped_events）
+        """
+        key = (user_id, product_id, action_type)
+        with self._lock:
+            if rating is not None and not 1 <= rating <= 5:
+                self._rejected_events += 1
+                return False
+            if self._pending_events >= self.max_backlog or self._stopped.is_set():
+                self._dropped_events += 1
+                return False
+            entry = self._buffer.get(key)
+            if entry is None:
+                self._buffer[key] = [1, rating]
+            else:
+                entry[0] += 1
+                if rating is not None:
+                    entry[1] = rating
+            self._pending_events += 1
+            if self._pending_events >= self.batch_size:
+                self._wakeup.set()
+        return True
+
+    def add_many(self, behaviors: Iterable[Dict]):
+        """缓冲多条用户行为事件（字典格式与示例数据一致）"""
+        for behavior in behaviors:
+            self.add(behavior["user_id"], behavior["product_id"],
+                     behavior["action_type"], behavior.get("rating"))
+
+    def flush(self) -> int:
+        """
+        立即将缓冲区写入数据库
+
+        连接类错误（OperationalError/InterfaceError）时整批放回缓冲区并在下次刷新时重连；
+        其他错误（如违反约束）时逐行重试，无法写入的行被隔离丢弃并计入 rejected_events。
+
+        Returns:
+            本次写入的行数
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._buffer:
+                    return 0
+                buffer, self._buffer = self._buffer, {}
+                events, self._pending_events = self._pending_events, 0
+
+            rows = [
+                (user_id, product_id, action_type, rating, count)
+                for (user_id, product_id, action_type), (count, rating) in buffer.items()
+            ]
+
+            start = time.perf_counter()
+            try:
+                try:
+                    self._write_batch(rows)
+                    written = rows
+                except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                    raise
+                except Exception as e:
+                    print(f"⚠️ 批量写入用户行为失败，改为逐行写入: {e}")
+                    self._rollback_quietly()
+                    written = self._write_rows_individually(rows)
+            except Exception as e:
+                print(f"❌ 批量写入用户行为失败: {e}")
+                self._requeue(buffer, events)
+                self._failed_flushes += 1
+                self._reset_connection()
+                return 0
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            written_events = sum(row[4] for row in written)
+            self._flush_count += 1
+            self._flushed_events += written_events
+            self._flushed_rows += len(written)
+            self._rejected_events += events - written_events
+            self._rejected_rows += len(rows) - len(written)
+            self._last_flush_ms = elapsed_ms
+            self._total_flush_ms += elapsed_ms
+            self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+
+        if self.on_flush and written:
+            try:
+                self.on_flush({row[0] for row in written})
+            except Exception as e:
+                print(f"❌ 用户行为写入回调失败: {e}")
+        return len(written)
+
+    def _write_batch(self, rows: List[Tuple]):
+        """通过 execute_values 在一个事务中写入整批数据（连接失效时先重连）"""
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.db_config)
+        cur = self.conn.cursor()
+        try:
+            execute_values(cur, self.INSERT_SQL, rows, page_size=self.batch_size)
+        finally:
+            cur.close()
+        self.conn.commit()
+
+    def _write_rows_individually(self, rows: List[Tuple]) -> List[Tuple]:
+        """
+        逐行写入（每行一个事务），隔离无法写入的行
+
+        连接类错误会向上抛出，由调用方将整批放回缓冲区。
+
+        Returns:
+            成功写入的行
+        """
+        written = []
+        for row in rows:
+            try:
+                self._write_batch([row])
+                written.append(row)
+            except (psycopg2.InterfaceError, psycopg2.OperationalError):
+                raise
+            except Exception as e:
+                print(f"❌ 隔离无法写入的用户行为 {row}: {e}")
+                self._rollback_quietly()
+        return written
+
+    def _rollback_quietly(self):
+        try:
+            self.conn.rollback()
+        except Exception:
+            self._reset_connection()
+
+    def _reset_connection(self):
+        """丢弃失效的连接，下次刷新时重新连接"""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+
+    def _requeue(self, buffer: Dict[Tuple[int, int, str], List], events: int):
+        """写入失败时将事件合并回缓冲区，等待下次刷新"""
+        with self._lock:
+            for key, (count, rating) in buffer.items():
+                entry = self._buffer.get(key)
+                if entry is None:
+                    self._buffer[key] = [count, rating]
+                else:
+                    # 缓冲区中的事件更新，评分以其为准
+                    entry[0] += count
+                    if entry[1] is None:
+                        entry[1] = rating
+            self._pending_events += events
+
+    def _run(self):
+        """后台线程：按时间或数量阈值刷新"""
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # 保证后台线程存活，事件留待下次刷新
+                print(f"❌ 用户行为后台刷新异常: {e}")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """获取写入延迟和积压指标"""
+        with self._lock:
+            pending_events = self._pending_events
+            pending_rows = len(self._buffer)
+        return {
+            "flusher_alive": self._thread is not None and self._thread.is_alive(),
+            "pending_events": pending_events,
+            "pending_rows": pending_rows,
+            "dropped_events": self._dropped_events,
+            "rejected_events": self._rejected_events,
+            "rejected_rows": self._rejected_rows,
+            "flush_count": self._flush_count,
+            "failed_flushes": self._failed_flushes,
+            "flushed_events": self._flushed_events,
+            "flushed_rows": self._flushed_rows,
+            "last_flush_ms": self._last_flush_ms,
+            "avg_flush_ms": self._total_flush_ms / self._flush_count if self._flush_count else 0.0,
+            "max_flush_ms": self._max_flush_ms,
+        }
+
+    def close(self) -> int:
+        """
+        停止后台线程，写入剩余事件并关闭连接（未调用 start() 时也会建立连接写入）
+
+        Returns:
+            未能写入的事件数，0 表示全部写入
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            pending_events = self._pending_events
+        if pending_events:
+            print(f"⚠️ 关闭写入器时仍有 {pending_events} 条用户行为未写入")
+        self._reset_connection()
+        return pending_events
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ResultCache:
+    """
+    搜索与推荐结果缓存
+
+    本地使用 LRU + TTL 淘汰；可选传入共享存储（任意 MutableMapping，
+    如 shelve.open(path) 返回的文件存储）作为多进程共享的二级缓存。
+    失效基于版本号：产品写入时递增目录版本，用户行为写入时递增该用户所在分桶的版本，
+    读取时版本不一致的条目视为过期。用户按 user_id 取模分桶，版本表大小固定，
+    同桶用户的行为写入会互相失效（只会多失效，不会读到旧结果）。
+    """
+
+    CATALOG_VERSION_KEY = "__version__:catalog"
+    USER_VERSION_KEY = "__version__:user:{}"
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60.0,
+                 backend: Optional[MutableMapping] = None,
+                 user_version_buckets: int = 65536):
+        """
+        Args:
+            max_entries: 本地缓存最大条目数，为 0 时禁用缓存
+            ttl: 条目存活时间（秒）
+            backend: 可选的共享存储，键为字符串，值需可 pickle
+            user_version_buckets: 用户版本分桶数，决定版本表的最大条目数
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.user_version_buckets = user_version_buckets
+        self._entries: "OrderedDict[str, Tuple[Any, float, Tuple[int, int]]]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._stale = 0
+        self._evictions = 0
+        self._total_hit_age = 0.0
+        self._max_hit_age = 0.0
+
+    @staticmethod
+    def _key_default(value):
+        """将 Decimal、numpy 标量等非 JSON 原生类型规范化"""
+        if isinstance(value, numbers.Integral):
+            return int(value)
+        if isinstance(value, (numbers.Real, Decimal)):
+            return float(value)
+        if isinstance(value, (tuple, set, frozenset)):
+            return list(value)
+        return str(value)
+
+    @staticmethod
+    def make_key(kind: str, *parts) -> str:
+        """由请求类型和参数生成缓存键"""
+        return json.dumps([kind, *parts], ensure_ascii=False, default=ResultCache._key_default)
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """规范化查询文本：去除多余空白并转小写"""
+        return " ".join(query.split()).lower()
+
+    def _get_version(self, name: str) -> int:
+        if self.backend is not None:
+            return self.backend.get(name, 0)
+        return self._versions.get(name, 0)
+
+    def _bump_version(self, name: str):
+        if self.backend is not None:
+            self.backend[name] = self.backend.get(name, 0) + 1
+        else:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def _user_version_key(self, user_id: int) -> str:
+        return self.USER_VERSION_KEY.format(int(user_id) % self.user_version_buckets)
+
+    def snapshot(self, user_id: Optional[int] = None) -> Tuple[int, int]:
+        """
+        获取当前 (目录版本, 用户版本)
+
+        应在查询数据库之前获取并传给 get/put，避免查询期间的写入被误缓存为最新结果。
+        """
+        with self._lock:
+            catalog_version = self._get_version(self.CATALOG_VERSION_KEY)
+            user_version = self._get_version(self._user_version_key(user_id)) if user_id is not None else 0
+        return catalog_version, user_version
+
+    def bump_catalog_version(self):
+        """产品数据变更后调用，使所有缓存结果失效"""
+        with self._lock:
+            self._bump_version(self.CATALOG_VERSION_KEY)
+
+    def bump_user_versions(self, user_ids: Iterable[int]):
+        """用户行为变更后调用，使这些用户的推荐结果失效"""
+        with self._lock:
+            for key in {self._user_version_key(user_id) for user_id in user_ids}:
+                self._bump_version(key)
+
+    def get(self, key: str, versions: Tuple[int, int]) -> Optional[Any]:
+        """
+        读取缓存
+
+        Args:
+            key: make_key 生成的缓存键
+            versions: snapshot 返回的版本号
+
+        Returns:
+            命中时返回缓存值，否则返回 None
+        """
+        if self.max_entries <= 0:
+            return None
+        versions = tuple(versions)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            reason = self._check_entry(entry, versions, now)
+            if entry is not None and reason is not None:
+                self._entries.pop(key, None)
+
+            # 本地未命中或已失效时，检查共享存储（可能已被其他进程更新）
+            if reason is not None and self.backend is not None:
+                shared_entry = self.backend.get(key)
+                shared_reason = self._check_entry(shared_entry, versions, now)
+                if shared_reason is None:
+                    entry, reason = shared_entry, None
+                elif shared_entry is not None:
+                    # 共享条目本身已过期或版本落后，才从共享存储删除
+                    self.backend.pop(key, None)
+                    reason = shared_reason
+
+            if reason is not None:
+                if reason == "expired":
+                    self._expired += 1
+                elif reason == "stale":
+                    self._stale += 1
+                self._misses += 1
+                return None
+
+            value, created_at, _ = entry
+            age = now - created_at
+            self._hits += 1
+            self._total_hit_age += age
+            self._max_hit_age = max(self._max_hit_age, age)
+            self._store_local(key, entry)
+            return value
+
+    def _check_entry(self, entry: Optional[Tuple[Any, float, Tuple[int, int]]],
+                     versions: Tuple[int, int], now: float) -> Optional[str]:
+        """检查条目有效性：有效返回 None，否则返回失效原因 missing/expired/stale"""
+        if entry is None:
+            return "missing"
+        _, created_at, entry_versions = entry
+        if now - created_at > self.ttl:
+            return "expired"
+        if tuple(entry_versions) != versions:
+            return "stale"
+        return None
+
+    def put(self, key: str, value: Any, versions: Tuple[int, int]):
+        """写入缓存，versions 为查询前 snapshot 返回的版本号"""
+        if self.max_entries <= 0:
+            return
+        entry = (value, time.time(), tuple(versions))
+        with self._lock:
+            self._store_local(key, entry)
+            if self.backend is not None:
+                self.backend[key] = entry
+
+    def _store_local(self, key: str, entry: Tuple[Any, float, Tuple[int, int]]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def clear(self):
+        """清空本地缓存（共享存储中的条目依靠 TTL 与版本号失效）"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """获取命中率和陈旧度指标"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "expired": self._expired,
+                "stale": self._stale,
+                "evictions": self._evictions,
+                "avg_hit_age_s": self._total_hit_age / self._hits if self._hits else 0.0,
+                "max_hit_age_s": self._max_hit_age,
+                "catalog_version": self._get_version(self.CATALOG_VERSION_KEY),
+            }
+
+
+# 列式结果中的数值列
+RESULT_DTYPE = np.dtype([("id", np.int64), ("score", np.float64), ("price", np.float64)])
+
+# 列式查询额外返回的向量列（用于 MMR 等后处理）
+EMBEDDING_COLUMN = ", description_embedding"
+
+
+def parse_embeddings(values: Sequence) -> np.ndarray:
+    """
+    将数据库返回的一批向量解析为 (n, dim) 的 float32 矩阵
+
+    支持 pgvector 文本格式 '[0.1,0.2,...]'（str/bytes），
+    以及已注册 pgvector 类型时返回的 numpy 数组或列表。
+    """
+    if len(values) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    if isinstance(values[0], (str, bytes)):
+        texts = [v.decode('utf-8') if isinstance(v, bytes) else v for v in values]
+        return _parse_concatenated_vectors("".join(text.strip() for text in texts), len(texts))
+    return np.asarray(values, dtype=np.float32)
+
+
+def _parse_concatenated_vectors(text: str, count: int) -> np.ndarray:
+    """解析首尾相接的向量文本 '[0.1,0.2][0.3,0.4]...' 为 (count, dim) 矩阵"""
+    if count == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    joined = text.replace("][", ",").strip("[]")
+    return np.fromstring(joined, dtype=np.float32, sep=",").reshape(count, -1)
+
+
+def _object_column(values: Sequence) -> np.ndarray:
+    """构造一维 object 数组（避免列表元素被展开为多维）"""
+    column = np.empty(len(values), dtype=object)
+    column[:] = list(values)
+    return column
+
+
+class ProductResult:
+    """单个产品结果"""
+
+    __slots__ = ("id", "name", "description", "category", "price", "brand", "tags", "similarity")
+
+    def __init__(self, id: int, name: str, description: str, category: str, price,
+                 brand: str, tags: List[str], similarity: Optional[float] = None):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.category = category
+        self.price = price
+        self.brand = brand
+        self.tags = tags
+        self.similarity = similarity
+
+    @classmethod
+    def from_row(cls, row: Tuple) -> "ProductResult":
+        """由查询结果行（7列或含相似度的8列）构造"""
+        return cls(*row[:8])
+
+    def format(self, rank: int) -> str:
+        """格式化为展示文本"""
+        if self.similarity is not None:
+            title = f"{rank}. {self.name} (相似度: {self.similarity:.3f})\n"
+        else:
+            title = f"{rank}. {self.name}\n"
+        return (
+            f"{title}"
+            f"   分类: {self.category} | 品牌: {self.brand} | 价格: ¥{self.price}\n"
+            f"   描述: {self.description}\n"
+            f"   标签: {self.tags}\n"
+            f"{'-' * 60}\n"
+        )
+
+
+class ColumnarResults:
+    """
+    列式产品结果
+
+    数值列 (id, score, price) 存放在结构化数组 records 中（缺失价格为 nan），
+    文本列与原始价格为 object 数组（缺失值保留为 None），
+    embeddings 为可选的 (n, dim) 向量矩阵。
+    去重、品牌限额和 MMR 多样性重排均基于数组运算，返回新的 ColumnarResults。
+    """
+
+    __slots__ = ("records", "names", "descriptions", "categories", "price_values",
+                 "brands", "tags", "embeddings")
+
+    def __init__(self, records: np.ndarray, names: np.ndarray, descriptions: np.ndarray,
+                 categories: np.ndarray, price_values: np.ndarray, brands: np.ndarray,
+                 tags: np.ndarray, embeddings: Optional[np.ndarray] = None):
+        self.records = records
+        self.names = names
+        self.descriptions = descriptions
+        self.categories = categories
+        self.price_values = price_values
+        self.brands = brands
+        self.tags = tags
+        self.embeddings = embeddings
+
+    # 将产品查询包装为单行聚合查询，各列以数组/拼接文本返回，避免逐行构造元组
+    AGGREGATE_SQL = """
+    SELECT
+        COUNT(*),
+        string_agg(r.id::text, ',' ORDER BY r.similarity DESC, r.id),
+        string_agg(r.similarity::text, ',' ORDER BY r.similarity DESC, r.id),
+        array_agg(r.price ORDER BY r.similarity DESC, r.id),
+        array_agg(r.name ORDER BY r.similarity DESC, r.id),
+        array_agg(r.description ORDER BY r.similarity DESC, r.id),
+        array_agg(r.category ORDER BY r.similarity DESC, r.id),
+        array_agg(r.brand ORDER BY r.similarity DESC, r.id),
+        json_agg(r.tags ORDER BY r.similarity DESC, r.id),
+        string_agg(r.description_embedding::text, '' ORDER BY r.similarity DESC, r.id)
+    FROM ({inner}) r;
+    """
+
+    @classmethod
+    def aggregate_sql(cls, sql: str) -> str:
+        """
+        将返回 (id, name, description, category, price, brand, tags, similarity, description_embedding)
+        的查询包装为按列聚合的单行查询，结果交给 from_aggregate 解析
+        """
+        return cls.AGGREGATE_SQL.format(inner=sql.strip().rstrip(";"))
+
+    @classmethod
+    def from_aggregate(cls, row: Tuple) -> "ColumnarResults":
+        """
+        由 aggregate_sql 查询返回的单行构造
+
+        id、相似度和向量列由 NumPy 直接从拼接文本解析；文本列由驱动解析为数组。
+        """
+        count, ids, scores, prices, names, descriptions, categories, brands, tags, embeddings = row
+        if not count:
+            return cls.from_rows([])
+        if isinstance(tags, str):
+            tags = json.loads(tags)
+
+        records = np.empty(count, dtype=RESULT_DTYPE)
+        records["id"] = np.fromstring(ids, dtype=np.int64, sep=",")
+        records["score"] = np.fromstring(scores, dtype=np.float64, sep=",")
+        records["price"] = np.array(prices, dtype=np.float64)
+        return cls(
+            records,
+            _object_column(names),
+            _object_column(descriptions),
+            _object_column(categories),
+            _object_column(prices),
+            _object_column(brands),
+            _object_column(tags),
+            _parse_concatenated_vectors(embeddings or "", count),
+        )
+
+    @classmethod
+    def from_rows(cls, rows: List[Tuple]) -> "ColumnarResults":
+        """
+        由查询结果行构造
+
+        行格式为 (id, name, description, category, price, brand, tags, similarity[, embedding])，
+        含第9列时解析为 embeddings。该方法需逐行转置，数据库查询请使用 aggregate_sql/from_aggregate。
+        """
+        if not rows:
+            return cls(np.empty(0, dtype=RESULT_DTYPE), *(_object_column([]) for _ in range(6)),
+                       np.empty((0, 0), dtype=np.float32))
+
+        columns = list(zip(*rows))
+        records = np.empty(len(rows), dtype=RESULT_DTYPE)
+        records["id"] = columns[0]
+        records["score"] = columns[7]
+        records["price"] = np.array(columns[4], dtype=np.float64)
+        embeddings = parse_embeddings(columns[8]) if len(columns) > 8 else None
+        return cls(
+            records,
+            _object_column(columns[1]),
+            _object_column(columns[2]),
+            _object_column(columns[3]),
+            _object_column(columns[4]),
+            _object_column(columns[5]),
+            _object_column(columns[6]),
+            embeddings,
+        )
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.records["id"]
+
+    @property
+    def scores(self) -> np.ndarray:
+        return self.records["score"]
+
+    @property
+    def prices(self) -> np.ndarray:
+        return self.records["price"]
+
+    def take(self, indices: np.ndarray) -> "ColumnarResults":
+        """按下标选取子集（保持下标顺序）"""
+        indices = np.asarray(indices, dtype=np.intp)
+        return ColumnarResults(
+            self.records[indices],
+            self.names[indices],
+            self.descriptions[indices],
+            self.categories[indices],
+            self.price_values[indices],
+            self.brands[indices],
+            self.tags[indices],
+            self.embeddings[indices] if self.embeddings is not None else None,
+        )
+
+    def copy(self) -> "ColumnarResults":
+        """复制所有列（object 列中的元素本身不复制）"""
+        return ColumnarResults(
+            self.records.copy(),
+            self.names.copy(),
+            self.descriptions.copy(),
+            self.categories.copy(),
+            self.price_values.copy(),
+            self.brands.copy(),
+            self.tags.copy(),
+            self.embeddings.copy() if self.embeddings is not None else None,
+        )
+
+    def sort_by_score(self) -> "ColumnarResults":
+        """按相似度降序排列"""
+        return self.take(np.argsort(-self.scores, kind="stable"))
+
+    def dedup(self) -> "ColumnarResults":
+        """按产品ID去重，保留相似度最高的一条，结果按相似度降序"""
+        order = np.argsort(-self.scores, kind="stable")
+        _, first = np.unique(self.ids[order], return_index=True)
+        return self.take(order[np.sort(first)])
+
+    def brand_cap(self, max_per_brand: int) -> "ColumnarResults":
+        """
+        每个品牌最多保留 max_per_brand 个相似度最高的产品，结果按相似度降序
+
+        品牌为空（NULL）的产品不属于任何品牌，不受限额约束。
+        """
+        order = np.argsort(-self.scores, kind="stable")
+        ordered_brands = self.brands[order]
+        branded = np.not_equal(ordered_brands, None).astype(bool)
+        keep = np.ones(len(order), dtype=bool)
+        if branded.any():
+            _, codes = np.unique(ordered_brands[branded].astype(str), return_inverse=True)
+            codes = codes.reshape(-1)
+            # 在每个品牌内部按相似度计算名次
+            by_brand = np.argsort(codes, kind="stable")
+            sorted_codes = codes[by_brand]
+            group_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+            group_sizes = np.diff(np.r_[group_starts, len(sorted_codes)])
+            ranks = np.empty(len(codes), dtype=np.intp)
+            ranks[by_brand] = np.arange(len(codes)) - np.repeat(group_starts, group_sizes)
+            keep[branded] = ranks < max_per_brand
+        return self.take(order[keep])
+
+    def mmr(self, k: int, lambda_: float = 0.7) -> "ColumnarResults":
+        """
+        最大边际相关性（MMR）多样性重排
+
+        Args:
+            k: 返回结果数量
+            lambda_: 相关性权重，越小越偏向多样性
+
+        Returns:
+            按 MMR 选择顺序排列的结果
+        """
+        n = len(self)
+        k = min(k, n)
+        if k <= 0:
+            return self.take(np.empty(0, dtype=np.intp))
+        if self.embeddings is None:
+            raise ValueError("MMR 重排需要向量列，请使用 columnar=True 查询")
+
+        norms = np.linalg.norm(self.embeddings, axis=1, keepdims=True)
+        unit = self.embeddings / np.where(norms == 0, 1, norms)
+        relevance = self.scores.astype(np.float64)
+        max_similarity = np.zeros(n)
+        selected = np.zeros(n, dtype=bool)
+        picks = np.empty(k, dtype=np.intp)
+
+        for step in range(k):
+            mmr_scores = lambda_ * relevance - (1 - lambda_) * max_similarity
+            mmr_scores[selected] = -np.inf
+            best = int(np.argmax(mmr_scores))
+            picks[step] = best
+            selected[best] = True
+            np.maximum(max_similarity, unit @ unit[best], out=max_similarity)
+
+        return self.take(picks)
+
+    def to_products(self) -> List[ProductResult]:
+        """转换为 ProductResult 列表"""
+        return [
+            ProductResult(int(id), name, desc, category, price, brand, tags, float(score))
+            for id, name, desc, category, price, brand, tags, score in zip(
+                self.ids, self.names, self.descriptions, self.categories,
+                self.price_values, self.brands, self.tags, self.scores,
+            )
+        ]
+
 
 class ProductRecommendationSystem:
-    def __init__(self, db_config: Dict[str, str]):
+    def __init__(self, db_config: Dict[str, str], result_cache: Optional[ResultCache] = None):
         """
         初始化产品推荐系统
         
         Args:
             db_config: 数据库连接配置
+            result_cache: 结果缓存，默认使用进程内 LRU 缓存；
+                          传入 ResultCache(max_entries=0) 可禁用
         """
         self.db_config = db_config
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
         self.conn = None
         self.model = SentenceTransformer('./model', local_files_only=True)
         self.embedding_dim = 384  # all-MiniLM-L6-v2 的向量维度
@@ -72,6 +854,7 @@ class ProductRecommendationSystem:
             product_id INTEGER NOT NULL,
             action_type VARCHAR(50) NOT NULL, -- 'view', 'like', 'purchase', 'add_to_cart'
             rating INTEGER CHECK (rating >= 1 AND rating <= 5),
+            event_count INTEGER DEFAULT 1, -- 刷新窗口内预聚合的事件数，NULL 视为 1
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
         """
@@ -83,6 +866,17 @@ class ProductRecommendationSystem:
             print(f"❌ 创建用户行为表失败: {e}")
             
         self.conn.commit()
+        
+        # 4. 为旧版本创建的用户行为表补充 event_count 列
+        # 先添加无默认值的可空列再设置默认值，只修改元数据，避免重写整表
+        try:
+            cur.execute("ALTER TABLE user_behaviors ADD COLUMN IF NOT EXISTS event_count INTEGER;")
+            cur.execute("ALTER TABLE user_behaviors ALTER COLUMN event_count SET DEFAULT 1;")
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            print(f"❌ 添加 event_count 列失败: {e}")
+            
         cur.close()
     
     def create_vector_index(self):
@@ -213,6 +1007,7 @@ class ProductRecommendationSystem:
         
         self.conn.commit()
         cur.close()
+        self.result_cache.bump_catalog_version()
         print("✅ 示例产品数据插入成功")
     
     def insert_sample_user_behaviors(self):
@@ -229,49 +1024,88 @@ class ProductRecommendationSystem:
             {"user_id": 3, "product_id": 8, "action_type": "add_to_cart", "rating": None},
         ]
         
-        cur = self.conn.cursor()
+        ingestor = self.create_behavior_ingestor()
+        ingestor.add_many(sample_behaviors)
+        pending_events = ingestor.close()
+        rejected_events = ingestor.get_metrics()["rejected_events"]
         
-        for behavior in sample_behaviors:
-            insert_sql = """
-            INSERT INTO user_behaviors (user_id, product_id, action_type, rating)
-            VALUES (%s, %s, %s, %s)
-            """
-            
-            try:
-                cur.execute(insert_sql, (
-                    behavior["user_id"],
-                    behavior["product_id"],
-                    behavior["action_type"],
-                    behavior["rating"]
-                ))
-            except Exception as e:
-                print(f"❌ 插入用户行为失败: {e}")
+        if pending_events or rejected_events:
+            print(f"❌ 示例用户行为数据插入不完整: {pending_events} 条未写入, {rejected_events} 条被拒绝")
+        else:
+            print("✅ 示例用户行为数据插入成功")
+    
+    def create_behavior_ingestor(self, batch_size: int = 1000,
+                                 flush_interval: float = 1.0) -> BehaviorIngestor:
+        """
+        创建用户行为批量写入器（使用独立连接，不阻塞查询）
         
-        self.conn.commit()
-        cur.close()
-        print("✅ 示例用户行为数据插入成功")
+        Args:
+            batch_size: 缓冲事件数阈值
+            flush_interval: 最长刷新间隔（秒）
+            
+        Returns:
+            未启动的写入器，可配合 with 语句或 start()/close() 使用
+        """
+        return BehaviorIngestor(self.db_config, batch_size=batch_size,
+                                flush_interval=flush_interval,
+                                on_flush=self.result_cache.bump_user_versions)
     
-    def semantic_search(self, query: str, limit: int = 5) -> List[Tuple]:
+    def _query_products(self, sql: str, params, cache_key: str, versions: Tuple[int, int],
+                        columnar: bool) -> Union[List[Tuple], ColumnarResults]:
+        """执行产品查询，写入缓存；列式模式下在 SQL 中按列聚合后直接构造列式结果"""
+        cur = self.conn.cursor()
+        try:
+            if columnar:
+                cur.execute(ColumnarResults.aggregate_sql(sql), params)
+                results = ColumnarResults.from_aggregate(cur.fetchone())
+            else:
+                cur.execute(sql, params)
+                results = cur.fetchall()
+        finally:
+            cur.close()
+        if columnar:
+            self.result_cache.put(cache_key, results.copy(), versions)
+            return results
+        self.result_cache.put(cache_key, results, versions)
+        return list(results)
+    
+    def _cached_products(self, cache_key: str,
+                         versions: Tuple[int, int]) -> Optional[Union[List[Tuple], ColumnarResults]]:
+        """读取缓存的产品查询结果（返回副本，调用方修改不影响缓存）"""
+        cached = self.result_cache.get(cache_key, versions)
+        if cached is None:
+            return None
+        if isinstance(cached, ColumnarResults):
+            return cached.copy()
+        return list(cached)
+    
+    def semantic_search(self, query: str, limit: int = 5,
+                        columnar: bool = False) -> Union[List[Tuple], ColumnarResults]:
         """
         基于语义相似度搜索产品
         
         Args:
             query: 搜索查询文本
             limit: 返回结果数量
+            columnar: 为 True 时返回带向量列的 ColumnarResults
             
         Returns:
             相似产品列表，包含相似度分数
         """
+        cache_key = ResultCache.make_key("semantic", ResultCache.normalize_query(query), limit, columnar)
+        versions = self.result_cache.snapshot()
+        cached = self._cached_products(cache_key, versions)
+        if cached is not None:
+            return cached
+        
         # 生成查询的嵌入向量
         query_embedding = self.generate_embedding(query)
         
-        cur = self.conn.cursor()
-        
         # 使用余弦相似度进行向量搜索
-        search_sql = """
+        search_sql = f"""
         SELECT 
             id, name, description, category, price, brand, tags,
-            1 - (description_embedding <=> %s::vector) as similarity
+            1 - (description_embedding <=> %s::vector) as similarity{EMBEDDING_COLUMN if columnar else ""}
         FROM products
         WHERE description_embedding IS NOT NULL
         ORDER BY description_embedding <=> %s::vector
@@ -279,20 +1113,30 @@ class ProductRecommendationSystem:
         """
         
         try:
-            cur.execute(search_sql, (query_embedding, query_embedding, limit))
-            results = cur.fetchall()
-            cur.close()
-            return results
+            return self._query_products(search_sql, (query_embedding, query_embedding, limit),
+                                        cache_key, versions, columnar)
         except Exception as e:
             print(f"❌ 语义搜索失败: {e}")
-            cur.close()
-            return []
+            return ColumnarResults.from_rows([]) if columnar else []
     
-    def recommend_by_user_history(self, user_id: int, limit: int = 5) -> List[Tuple]:
+    def recommend_by_user_history(self, user_id: int, limit: int = 5,
+                                  columnar: bool = False) -> Union[List[Tuple], ColumnarResults]:
         """
         基于用户历史行为推荐产品
+        
+        Args:
+            user_id: 用户ID
+            limit: 返回结果数量
+            columnar: 为 True 时返回带向量列的 ColumnarResults
         """
 
+        cache_key = ResultCache.make_key("recommend", user_id, limit, columnar)
+        versions = self.result_cache.snapshot(user_id)
+        cached = self._cached_products(cache_key, versions)
+        if cached is not None:
+            return cached
+        empty = ColumnarResults.from_rows([]) if columnar else []
+
         cur = self.conn.cursor()
 
         # 获取用户喜欢的产品
@@ -308,40 +1152,27 @@ class ProductRecommendationSystem:
 
         cur.execute(get_user_preferences_sql, (user_id,))
         user_preferences = cur.fetchall()
+        cur.close()
         
         if not user_preferences:
-            cur.close()
-            return []
-        
-        # 计算用户偏好向量（加权平均）
-        weighted_embeddings = []
-        total_weight = 0
+            return empty
         
-        for embedding_bytes, rating in user_preferences:
-            # 转为字符串
-            if isinstance(embedding_bytes, bytes):
-                embedding_str = embedding_bytes.decode('utf-8')
-            else:
-                embedding_str = embedding_bytes
-
-            embedding = np.array(json.loads(embedding_str))  # 解析 JSON 数组
-
-            weight = rating / 5.0
-            weighted_embeddings.append(embedding * weight)
-            total_weight += weight
+        # 计算用户偏好向量（按评分加权平均）
+        embedding_column, rating_column = zip(*user_preferences)
+        embeddings = parse_embeddings(embedding_column)
+        weights = np.asarray(rating_column, dtype=np.float64) / 5.0
+        total_weight = weights.sum()
         
         if total_weight == 0:
-            cur.close()
-            return []
-        
+            return empty
 
-        user_preference_vector = np.sum(weighted_embeddings, axis=0) / total_weight
+        user_preference_vector = (weights @ embeddings / total_weight).tolist()
 
         # 推荐查询（使用 vector 相似度）
-        recommend_sql = """
+        recommend_sql = f"""
             SELECT 
                 p.id, p.name, p.description, p.category, p.price, p.brand, p.tags,
-                1 - (p.description_embedding <=> %s::vector) as similarity
+                1 - (p.description_embedding <=> %s::vector) as similarity{EMBEDDING_COLUMN if columnar else ""}
             FROM products p
             WHERE p.description_embedding IS NOT NULL
             AND p.id NOT IN (
@@ -352,25 +1183,20 @@ class ProductRecommendationSystem:
             ORDER BY p.description_embedding <=> %s::vector
             LIMIT %s;
             """
-        user_preference_vector = user_preference_vector.tolist()
         try:
-            # ✅ 此处直接传入 numpy array，pgvector 会自动处理
-            cur.execute(recommend_sql, (
-                user_preference_vector,  # numpy array，pgvector 能识别
+            return self._query_products(recommend_sql, (
+                user_preference_vector,
                 user_id,
                 user_preference_vector,
                 limit
-            ))
-            results = cur.fetchall()
-            cur.close()
-            return results
+            ), cache_key, versions, columnar)
         except Exception as e:
             print(f"❌ 个性化推荐失败: {e}")
-            cur.close()
-            return []
+            return empty
     
     def hybrid_search(self, query: str, category: str = None, 
-                     price_range: Tuple[float, float] = None, limit: int = 5) -> List[Tuple]:
+                     price_range: Tuple[float, float] = None, limit: int = 5,
+                     columnar: bool = False) -> Union[List[Tuple], ColumnarResults]:
         """
         混合搜索：结合语义搜索和传统筛选
         
@@ -379,17 +1205,27 @@ class ProductRecommendationSystem:
             category: 产品类别筛选
             price_range: 价格范围筛选 (min_price, max_price)
             limit: 返回结果数量
+            columnar: 为 True 时返回带向量列的 ColumnarResults
             
         Returns:
             筛选后的相似产品列表
         """
+        cache_key = ResultCache.make_key(
+            "hybrid", ResultCache.normalize_query(query), category,
+            [float(p) for p in price_range] if price_range else None, limit, columnar
+        )
+        versions = self.result_cache.snapshot()
+        cached = self._cached_products(cache_key, versions)
+        if cached is not None:
+            return cached
+        
         query_embedding = self.generate_embedding(query)
         
         # 构建动态SQL查询
-        base_sql = """
+        base_sql = f"""
         SELECT 
             id, name, description, category, price, brand, tags,
-            1 - (description_embedding <=> %s::vector) as similarity
+            1 - (description_embedding <=> %s::vector) as similarity{EMBEDDING_COLUMN if columnar else ""}
         FROM products
         WHERE description_embedding IS NOT NULL
         """
@@ -415,16 +1251,11 @@ class ProductRecommendationSystem:
         
         params.extend([query_embedding, limit])
         
-        cur = self.conn.cursor()
         try:
-            cur.execute(base_sql, params)
-            results = cur.fetchall()
-            cur.close()
-            return results
+            return self._query_products(base_sql, params, cache_key, versions, columnar)
         except Exception as e:
             print(f"❌ 混合搜索失败: {e}")
-            cur.close()
-            return []
+            return ColumnarResults.from_rows([]) if columnar else []
     
     def get_database_stats(self):
         """获取数据库统计信息"""
@@ -438,9 +1269,9 @@ class ProductRecommendationSystem:
         cur.execute("SELECT COUNT(*) FROM products WHERE description_embedding IS NOT NULL;")
         embedded_count = cur.fetchone()[0]
         
-        # 用户行为总数
-        cur.execute("SELECT COUNT(*) FROM user_behaviors;")
-        behavior_count = cur.fetchone()[0]
+        # 用户行为记录数（预聚合后的行）与事件总数
+        cur.execute("SELECT COUNT(*), COALESCE(SUM(COALESCE(event_count, 1)), 0) FROM user_behaviors;")
+        behavior_count, behavior_event_count = cur.fetchone()
         
         # 索引信息
         cur.execute("""
@@ -456,6 +1287,7 @@ class ProductRecommendationSystem:
             "total_products": product_count,
             "embedded_products": embedded_count,
             "total_behaviors": behavior_count,
+            "total_behavior_events": behavior_event_count,
             "vector_indexes": indexes
         }
     
@@ -466,26 +1298,19 @@ class ProductRecommendationSystem:
             print("✅ 数据库连接已关闭")
 
 
-def format_products(products: List[Tuple]) -> str:
+def format_products(products: Union[List[Tuple], List[ProductResult], ColumnarResults]) -> str:
     """格式化产品列表输出"""
-    if not products:
+    if products is None or len(products) == 0:
         return "❌ 没有找到相关产品"
     
-    result = "\n" + "="*60 + "\n"
-    for i, product in enumerate(products, 1):
-        if len(product) == 8:  # 包含相似度分数
-            id, name, desc, category, price, brand, tags, similarity = product
-            result += f"{i}. {name} (相似度: {similarity:.3f})\n"
-        else:
-            id, name, desc, category, price, brand, tags = product
-            result += f"{i}. {name}\n"
-            
-        result += f"   分类: {category} | 品牌: {brand} | 价格: ¥{price}\n"
-        result += f"   描述: {desc}\n"
-        result += f"   标签: {tags}\n"
-        result += "-" * 60 + "\n"
+    if isinstance(products, ColumnarResults):
+        items = products.to_products()
+    else:
+        items = [p if isinstance(p, ProductResult) else ProductResult.from_row(p) for p in products]
     
-    return result
+    return "\n" + "=" * 60 + "\n" + "".join(
+        item.format(i) for i, item in enumerate(items, 1)
+    )
 
 
 def main():
@@ -528,7 +1353,7 @@ def main():
         stats = recommender.get_database_stats()
         print(f"   总产品数: {stats['total_products']}")
         print(f"   已嵌入产品数: {stats['embedded_products']}")
-        print(f"   用户行为记录数: {stats['total_behaviors']}")
+        print(f"   用户行为记录数: {stats['total_behaviors']} (事件数: {stats['total_behavior_events']})")
         print(f"   向量索引数: {len(stats['vector_indexes'])}")
         
         # 6. 演示语义搜索
@@ -562,6 +1387,14 @@ def main():
             name, similarity = product[1], product[7]
             print(f"   {name}: {similarity:.4f}")
         
+        # 10. 展示结果缓存
+        print("\n⚡ 演示5: 结果缓存")
+        recommender.semantic_search("无线耳机", limit=8)
+        recommender.recommend_by_user_history(user_id=1, limit=3)
+        cache_metrics = recommender.result_cache.get_metrics()
+        print(f"   命中次数: {cache_metrics['hits']} | 未命中次数: {cache_metrics['misses']}")
+        print(f"   命中率: {cache_metrics['hit_rate']:.2%} | 平均命中条目年龄: {cache_metrics['avg_hit_age_s']:.2f}s")
+        
     except Exception as e:
         print(f"❌ 运行出错: {e}")
     finally:
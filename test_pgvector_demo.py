@@ -0,0 +1,459 @@
+"""
+pgvector_demo 单元测试
+
+使用内存中的假连接替代数据库，覆盖批量写入、结果缓存和列式结果的关键路径。
+运行: python -m pytest -q
+"""
+
+import time
+from decimal import Decimal
+
+import numpy as np
+import psycopg2
+import pytest
+
+import pgvector_demo
+from pgvector_demo import (BehaviorIngestor, ColumnarResults, ProductRecommendationSystem,
+                           ResultCache, format_products)
+
+
+class FakeDatabase:
+    """记录写入的行，可模拟连接故障和违反约束的行"""
+
+    def __init__(self):
+        self.rows = []
+        self.down = False
+        self.bad_product_ids = set()
+
+    def check(self, rows):
+        if self.down:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        for row in rows:
+            if row[1] in self.bad_product_ids:
+                raise psycopg2.IntegrityError("violates foreign key constraint")
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+        self.staged = []
+
+    def cursor(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        return FakeCursor(self)
+
+    def commit(self):
+        self.db.rows.extend(self.staged)
+        self.staged = []
+
+    def rollback(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.staged = []
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = FakeDatabase()
+
+    def connect(**kwargs):
+        if database.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        return FakeConnection(database)
+
+    def execute_values(cur, sql, rows, page_size=100):
+        database.check(rows)
+        cur.conn.staged.extend(rows)
+
+    monkeypatch.setattr(pgvector_demo.psycopg2, "connect", connect)
+    monkeypatch.setattr(pgvector_demo, "execute_values", execute_values)
+    return database
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+# ---------------------------------------------------------------------------
+# BehaviorIngestor
+# ---------------------------------------------------------------------------
+
+def test_flush_aggregates_duplicate_events(db):
+    ingestor = BehaviorIngestor({})
+    for _ in range(3):
+        ingestor.add(1, 1, "view")
+    ingestor.add(1, 1, "like", 4)
+    ingestor.add(1, 1, "like", 5)
+
+    assert ingestor.flush() == 2
+    assert sorted(db.rows) == [(1, 1, "like", 5, 2), (1, 1, "view", None, 3)]
+    metrics = ingestor.get_metrics()
+    assert metrics["flushed_events"] == 5
+    assert metrics["flushed_rows"] == 2
+    assert metrics["pending_events"] == 0
+
+
+def test_add_rejects_invalid_rating(db):
+    ingestor = BehaviorIngestor({})
+    assert ingestor.add(1, 1, "like", 9) is False
+    assert ingestor.add(1, 1, "like", 0) is False
+    assert ingestor.add(1, 1, "like", 5) is True
+
+    metrics = ingestor.get_metrics()
+    assert metrics["rejected_events"] == 2
+    assert metrics["pending_events"] == 1
+
+
+def test_data_error_quarantines_bad_rows(db):
+    db.bad_product_ids.add(999)
+    ingestor = BehaviorIngestor({})
+    ingestor.add(1, 999, "view")
+    ingestor.add(1, 999, "view")
+    for product_id in range(1, 6):
+        ingestor.add(1, product_id, "view")
+
+    assert ingestor.flush() == 5
+    assert {row[1] for row in db.rows} == {1, 2, 3, 4, 5}
+    metrics = ingestor.get_metrics()
+    assert metrics["pending_events"] == 0
+    assert metrics["rejected_rows"] == 1
+    assert metrics["rejected_events"] == 2
+
+    # 后续批次不受影响
+    ingestor.add(2, 1, "view")
+    assert ingestor.flush() == 1
+
+
+def test_connection_error_requeues_and_reconnects(db):
+    ingestor = BehaviorIngestor({})
+    ingestor.add(1, 1, "view")
+    db.down = True
+
+    assert ingestor.flush() == 0
+    metrics = ingestor.get_metrics()
+    assert metrics["pending_events"] == 1
+    assert metrics["failed_flushes"] == 1
+
+    db.down = False
+    assert ingestor.flush() == 1
+    assert db.rows == [(1, 1, "view", None, 1)]
+
+
+def test_closed_connection_is_replaced(db):
+    ingestor = BehaviorIngestor({})
+    ingestor.add(1, 1, "view")
+    ingestor.flush()
+    ingestor.conn.close()
+
+    ingestor.add(1, 2, "view")
+    assert ingestor.flush() == 1
+    assert ingestor.get_metrics()["pending_events"] == 0
+
+
+def test_max_backlog_drops_new_events(db):
+    ingestor = BehaviorIngestor({}, max_backlog=2)
+    assert ingestor.add(1, 1, "view") is True
+    assert ingestor.add(1, 2, "view") is True
+    assert ingestor.add(1, 3, "view") is False
+    assert ingestor.get_metrics()["dropped_events"] == 1
+
+
+def test_background_flusher_survives_failures(db):
+    def failing_callback(user_ids):
+        raise RuntimeError("callback failed")
+
+    ingestor = BehaviorIngestor({}, flush_interval=0.01, on_flush=failing_callback)
+    ingestor.start()
+    try:
+        db.down = True
+        ingestor.add(1, 1, "view")
+        assert wait_until(lambda: ingestor.get_metrics()["failed_flushes"] >= 2)
+        assert ingestor.get_metrics()["flusher_alive"] is True
+
+        db.down = False
+        assert wait_until(lambda: ingestor.get_metrics()["flushed_events"] == 1)
+        assert ingestor.get_metrics()["flusher_alive"] is True
+    finally:
+        assert ingestor.close() == 0
+
+
+def test_on_flush_receives_written_user_ids(db):
+    flushed = []
+    ingestor = BehaviorIngestor({}, on_flush=flushed.append)
+    ingestor.add(1, 1, "view")
+    ingestor.add(2, 1, "view")
+    ingestor.flush()
+    assert flushed == [{1, 2}]
+
+
+def test_close_without_start_flushes(db):
+    ingestor = BehaviorIngestor({})
+    ingestor.add(1, 1, "view")
+
+    assert ingestor.close() == 0
+    assert db.rows == [(1, 1, "view", None, 1)]
+
+
+def test_close_reports_unwritten_events(db):
+    ingestor = BehaviorIngestor({})
+    ingestor.add(1, 1, "view")
+    db.down = True
+
+    assert ingestor.close() == 1
+
+
+def test_add_after_close_is_rejected(db):
+    ingestor = BehaviorIngestor({})
+    ingestor.close()
+
+    assert ingestor.add(1, 1, "view") is False
+    assert ingestor.get_metrics()["dropped_events"] == 1
+
+
+# ---------------------------------------------------------------------------
+# ResultCache
+# ---------------------------------------------------------------------------
+
+def test_cache_hit_and_lru_eviction():
+    cache = ResultCache(max_entries=2)
+    versions = cache.snapshot()
+    cache.put("a", [1], versions)
+    cache.put("b", [2], versions)
+    assert cache.get("a", versions) == [1]
+    cache.put("c", [3], versions)
+
+    assert cache.get("b", versions) is None
+    assert cache.get("a", versions) == [1]
+    metrics = cache.get_metrics()
+    assert metrics["evictions"] == 1
+    assert metrics["hits"] == 2
+    assert metrics["misses"] == 1
+
+
+def test_cache_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(pgvector_demo.time, "time", lambda: now[0])
+    cache = ResultCache(ttl=10)
+    versions = cache.snapshot()
+    cache.put("k", [1], versions)
+
+    now[0] += 5
+    assert cache.get("k", versions) == [1]
+    assert cache.get_metrics()["max_hit_age_s"] == 5
+    now[0] += 6
+    assert cache.get("k", versions) is None
+    assert cache.get_metrics()["expired"] == 1
+
+
+def test_catalog_bump_invalidates_all_entries():
+    cache = ResultCache()
+    versions = cache.snapshot(1)
+    cache.put("k", [1], versions)
+    cache.bump_catalog_version()
+
+    assert cache.get("k", cache.snapshot(1)) is None
+    assert cache.get_metrics()["stale"] == 1
+
+
+def test_user_bump_invalidates_only_that_user():
+    cache = ResultCache()
+    cache.put("u1", [1], cache.snapshot(1))
+    cache.put("u2", [2], cache.snapshot(2))
+    cache.bump_user_versions({1})
+
+    assert cache.get("u1", cache.snapshot(1)) is None
+    assert cache.get("u2", cache.snapshot(2)) == [2]
+
+
+def test_write_during_query_is_not_cached_as_fresh():
+    cache = ResultCache()
+    versions = cache.snapshot(1)  # 查询开始前取版本
+    cache.bump_user_versions({1})  # 查询期间发生写入
+    cache.put("k", ["computed before write"], versions)
+
+    assert cache.get("k", cache.snapshot(1)) is None
+
+
+def test_user_versions_are_bounded_by_buckets():
+    backend = {}
+    cache = ResultCache(backend=backend, user_version_buckets=16)
+    cache.bump_user_versions(range(10000))
+
+    assert len(backend) == 16
+
+
+def test_make_key_normalizes_numeric_types():
+    key = ResultCache.make_key("hybrid", [Decimal("5000"), np.float64(8000)], np.int64(3))
+    assert key == ResultCache.make_key("hybrid", [5000.0, 8000.0], 3)
+
+
+def test_shared_backend_serves_other_process_entries():
+    backend = {}
+    writer = ResultCache(backend=backend)
+    reader = ResultCache(backend=backend)
+    writer.put("k", [1], writer.snapshot())
+
+    assert reader.get("k", reader.snapshot()) == [1]
+
+
+def test_stale_local_entry_does_not_delete_fresh_shared_entry():
+    backend = {}
+    first = ResultCache(backend=backend)
+    second = ResultCache(backend=backend)
+    first.put("k", ["old"], first.snapshot(7))
+
+    second.bump_user_versions({7})
+    second.put("k", ["new"], second.snapshot(7))
+
+    assert first.get("k", first.snapshot(7)) == ["new"]
+    assert "k" in backend
+
+
+def test_stale_shared_entry_is_removed():
+    backend = {}
+    cache = ResultCache(backend=backend)
+    cache.put("k", [1], cache.snapshot())
+    cache.bump_catalog_version()
+
+    assert cache.get("k", cache.snapshot()) is None
+    assert "k" not in backend
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResultCache(max_entries=0)
+    versions = cache.snapshot()
+    cache.put("k", [1], versions)
+    assert cache.get("k", versions) is None
+
+
+# ---------------------------------------------------------------------------
+# ColumnarResults
+# ---------------------------------------------------------------------------
+
+ROWS = [
+    (1, "a", "desc a", "手机", Decimal("1.00"), None, ["t"], 0.9, "[1,0,0]"),
+    (2, "b", "desc b", "手机", None, None, ["t"], 0.85, "[0.99,0.1,0]"),
+    (3, "c", "desc c", "手机", Decimal("7999.00"), "Apple", ["t"], 0.5, "[0,1,0]"),
+    (1, "a", "desc a", "手机", Decimal("1.00"), None, ["t"], 0.7, "[1,0,0]"),
+    (4, "d", "desc d", "耳机", Decimal("3.50"), "Apple", ["x", "y"], 0.8, "[0,0,1]"),
+]
+
+
+def aggregate_row(rows):
+    """模拟 aggregate_sql 查询经驱动解析后的单行结果"""
+    rows = sorted(rows, key=lambda row: (-row[7], row[0]))
+    if not rows:
+        return (0,) + (None,) * 9
+    columns = list(zip(*rows))
+    return (
+        len(rows),
+        ",".join(str(v) for v in columns[0]),
+        ",".join(repr(v) for v in columns[7]),
+        list(columns[4]),
+        list(columns[1]),
+        list(columns[2]),
+        list(columns[3]),
+        list(columns[5]),
+        list(columns[6]),
+        "".join(columns[8]),
+    )
+
+
+def test_from_aggregate_matches_from_rows():
+    aggregated = ColumnarResults.from_aggregate(aggregate_row(ROWS))
+    transposed = ColumnarResults.from_rows(ROWS).sort_by_score()
+
+    for field in ("id", "score", "price"):
+        np.testing.assert_array_equal(aggregated.records[field], transposed.records[field])
+    np.testing.assert_array_equal(aggregated.embeddings, transposed.embeddings)
+    assert list(aggregated.brands) == list(transposed.brands)
+    assert format_products(aggregated) == format_products(transposed)
+
+
+def test_empty_results_support_full_pipeline():
+    for empty in (ColumnarResults.from_rows([]), ColumnarResults.from_aggregate(aggregate_row([]))):
+        result = empty.dedup().brand_cap(2).mmr(k=10)
+        assert len(result) == 0
+        assert format_products(result) == "❌ 没有找到相关产品"
+
+
+def test_dedup_keeps_highest_score():
+    result = ColumnarResults.from_rows(ROWS).dedup()
+    assert list(result.ids) == [1, 2, 4, 3]
+    assert result.scores[0] == pytest.approx(0.9)
+
+
+def test_brand_cap_leaves_null_brands_uncapped():
+    result = ColumnarResults.from_rows(ROWS).dedup().brand_cap(1)
+    assert list(result.ids) == [1, 2, 4]
+    assert list(result.brands) == [None, None, "Apple"]
+
+
+def test_mmr_prefers_diverse_results():
+    results = ColumnarResults.from_rows(ROWS).dedup()
+    # 1 与 2 几乎相同，多样性权重较高时第二个应选择方向不同的 4
+    assert list(results.mmr(k=3, lambda_=0.5).ids) == [1, 4, 3]
+    assert list(results.mmr(k=2, lambda_=1.0).ids) == [1, 2]
+
+
+def test_mmr_requires_embeddings():
+    rows = [row[:8] for row in ROWS]
+    with pytest.raises(ValueError):
+        ColumnarResults.from_rows(rows).mmr(k=2)
+
+
+def test_columnar_and_tuple_formatting_match():
+    rows = [row[:8] for row in ROWS[:3]]
+    assert format_products(ColumnarResults.from_rows(rows)) == format_products(rows)
+    assert "品牌: None" in format_products(rows)
+    assert "¥1.00" in format_products(rows)
+
+
+class AggregateCursor:
+    def __init__(self, row):
+        self.row = row
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+
+def test_cached_columnar_results_are_copies():
+    recommender = ProductRecommendationSystem.__new__(ProductRecommendationSystem)
+    recommender.result_cache = ResultCache()
+    cursor = AggregateCursor(aggregate_row(ROWS[:2]))
+    recommender.conn = type("Conn", (), {"cursor": lambda self: cursor})()
+    versions = recommender.result_cache.snapshot()
+
+    first = recommender._query_products("SELECT 1;", (), "k", versions, columnar=True)
+    assert "string_agg" in cursor.executed[0]
+    first.records["score"] = 0
+    hit = recommender._cached_products("k", versions)
+    hit.records["score"] = 0
+
+    np.testing.assert_allclose(recommender._cached_products("k", versions).scores, [0.9, 0.85])